@@ -4,6 +4,17 @@
 # Created: Oct 2023
 # License: Apache license
 
+import bisect
+import functools
+
+# =======================================================================================================
+# GLOBALs
+# =======================================================================================================
+
+# NOTE: we convert to kilo/mega/giga (multiplier=1000) not to kibi/mebi/gibi (multiplier=1024) bytes !!!
+BYTES_UNIT_THRESHOLDS = (1000, 1000000, 1000000000)
+BYTES_UNITS = ((1, "B"), (1000, "kB"), (1000000, "MB"), (1000000000, "GB"))
+
 # =======================================================================================================
 # GraphVizUtils
 # =======================================================================================================
@@ -18,13 +29,9 @@ class GraphVizUtils:
         pass
 
     @staticmethod
+    @functools.lru_cache(maxsize=8192)
     def pretty_print_bytes(bytes):
-        # NOTE: we convert to kilo/mega/giga (multiplier=1000) not to kibi/mebi/gibi (multiplier=1024) bytes !!!
-        if bytes < 1000:
-            return str(bytes) + "B"
-        elif bytes < 1000000:
-            return str(bytes // 1000) + "kB"
-        elif bytes < 1000000000:
-            return str(bytes // 1000000) + "MB"
-        else:
-            return str(bytes // 1000000000) + "GB"
+        # NOTE: results are memoized since the same byte counts (e.g. zero) are typically
+        #       repeated many times across the nodes of all trees
+        divisor, unit = BYTES_UNITS[bisect.bisect_right(BYTES_UNIT_THRESHOLDS, bytes)]
+        return str(bytes // divisor) + unit
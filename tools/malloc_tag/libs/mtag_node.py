@@ -4,12 +4,11 @@
 # Created: Oct 2023
 # License: Apache license
 
+import bisect
 import json
 import os
 import sys
-import decimal
 import graphviz  # pip3 install graphviz
-from decimal import *
 from malloc_tag.libs.mtag_graphviz_utils import *
 
 # =======================================================================================================
@@ -17,7 +16,16 @@ from malloc_tag.libs.mtag_graphviz_utils import *
 # =======================================================================================================
 
 SCOPE_PREFIX = "scope_"
-g_num_nodes = 0
+SCOPE_PREFIX_LEN = len(SCOPE_PREFIX)
+
+# upper bounds (excluded) of the "self weight" ranges used to pick the fillcolor/fontsize
+# of each graphviz node; a self weight above the last threshold selects the last entry:
+GRAPHVIZ_SELF_WEIGHT_THRESHOLDS = (5, 10, 20, 40, 60, 80)
+GRAPHVIZ_FILL_COLORS = ("1", "2", "3", "4", "5", "6", "7")
+GRAPHVIZ_FONT_SIZES = ("9", "10", "12", "14", "16", "18", "20")
+
+# translation table used to escape double quotes inside quoted graphviz IDs:
+GRAPHVIZ_QUOTE_ESCAPE = str.maketrans({'"': '\\"'})
 
 
 # =======================================================================================================
@@ -30,21 +38,42 @@ class MallocTagNode:
     This class represents a node in the JSON tree produced by the malloc-tag library.
     """
 
+    # snapshots may contain a very large number of nodes: avoid a per-instance __dict__
+    __slots__ = (
+        "childrenNodes",
+        "nLevel",
+        "ownerTID",
+        "postorderCache",
+        "nSubtreeNodes",
+        "nSubtreeLevels",
+        "name",
+        "graphvizNodeName",
+        "nTotalWeightPercentage",
+        "nSelfWeightPercentage",
+        "nBytesTotalAllocated",
+        "nBytesTotalFreed",
+        "nBytesSelfAllocated",
+        "nBytesSelfFreed",
+        "nTimesEnteredAndExited",
+        "nCallsTo_malloc",
+        "nCallsTo_realloc",
+        "nCallsTo_calloc",
+        "nCallsTo_free",
+    )
+
     def __init__(self, owner_tid, level=1):
-        global g_num_nodes
         self.childrenNodes = {}  # dict indexed by "scope name"
 
-        # allocate a new ID for this node
-        self.id = g_num_nodes
-        g_num_nodes += 1
-
         # a few info coming from the "caller"
         self.nLevel = level
         self.ownerTID = owner_tid
 
+        # list of all nodes of this subtree in postorder; computed on demand, see _postorder()
+        self.postorderCache = None
+
     def load_json(self, node_dict: dict, name: str):
         # this is the "scope name"
-        self.name = name
+        self.rename(name)
 
         # weights
         self.nTotalWeightPercentage = 0  # this will be recomputed on the fly later
@@ -62,18 +91,22 @@ class MallocTagNode:
         self.nCallsTo_free = node_dict["nCallsTo_free"]
 
         # recursive load
-        for scope in node_dict["nestedScopes"].keys():
+        for scope, scope_dict in node_dict["nestedScopes"].items():
             assert scope.startswith(SCOPE_PREFIX)
-            name = scope[len(SCOPE_PREFIX) :]
+            # the same scope names are typically repeated across all trees: interning them saves
+            # memory and speeds up the children lookups done by aggregate_with()
+            name = sys.intern(scope[SCOPE_PREFIX_LEN:])
 
             # load the node recursively
             t = MallocTagNode(owner_tid=self.ownerTID, level=self.nLevel + 1)
-            t.load_json(node_dict["nestedScopes"][scope], name)
+            t.load_json(scope_dict, name)
             assert name not in self.childrenNodes
 
             # store the node
             self.childrenNodes[name] = t
 
+        self.update_subtree_stats()
+
     def get_as_dict(self):
         d = {
             "nBytesTotalAllocated": self.nBytesTotalAllocated,
@@ -82,171 +115,191 @@ class MallocTagNode:
             "nBytesSelfFreed": self.nBytesSelfFreed,
             "nTimesEnteredAndExited": self.nTimesEnteredAndExited,
             # FIXME: rename to nTotalWeightPercentage also in the JSON output
-            "nWeightPercentage": Decimal(
-                self.nTotalWeightPercentage
-            ),  # see usage of DecimalEncoder later on
+            # NOTE: weights are already rounded to 2 decimal digits by compute_node_weights_recursively()
+            "nWeightPercentage": self.nTotalWeightPercentage,
             "nCallsTo_malloc": self.nCallsTo_malloc,
             "nCallsTo_realloc": self.nCallsTo_realloc,
             "nCallsTo_calloc": self.nCallsTo_calloc,
             "nCallsTo_free": self.nCallsTo_free,
             "nestedScopes": {},
         }
-        for n in self.childrenNodes:
-            d["nestedScopes"][SCOPE_PREFIX + n] = self.childrenNodes[n].get_as_dict()
+        nested = d["nestedScopes"]
+        for n, child in self.childrenNodes.items():
+            nested[SCOPE_PREFIX + n] = child.get_as_dict()
         return d
 
-    def save_as_graphviz_dot(self, graph):
-        thisNodeShape = "ellipse"
-        thisNodeLabels = []
+    def save_as_graphviz_dot(self, out: list):
+        """
+        Appends to the given list the DOT statements (one string per line) describing this node,
+        all its descendants and the edges connecting them.
+        The DOT statements are formatted directly, bypassing the node()/edge() methods of
+        the graphviz.Digraph class, so the list can be the "body" of such a Digraph.
+        """
+        # preorder traversal using an explicit stack of (parent DOT name, node) pairs:
+        # each node is emitted right after the edge coming from its parent
+        stack = [(None, self)]
+        while stack:
+            parentNodeName, node = stack.pop()
+            thisNodeName = node.get_graphviz_node_name().translate(
+                GRAPHVIZ_QUOTE_ESCAPE
+            )
+            if parentNodeName is not None:
+                out.append(
+                    f'\t"{parentNodeName}" -> "{thisNodeName}" '
+                    f'[label="w={node.nTotalWeightPercentage}%"]\n'
+                )
+            out.append(node.get_graphviz_node_statement(thisNodeName))
+
+            # push children in reverse order, so that they get popped in their natural order:
+            for child in reversed(list(node.childrenNodes.values())):
+                stack.append((thisNodeName, child))
+
+    def get_graphviz_node_statement(self, thisNodeName: str):
+        """
+        Returns the DOT statement describing this node, given its already-escaped DOT name.
+        """
         if self.nLevel == 1:
-            thisNodeLabels.append(f"thread={self.name}")
-            thisNodeLabels.append(f"TID={self.ownerTID}")
             thisNodeShape = "box"
+            headerLabels = (f"thread={self.name}", f"TID={self.ownerTID}")
         else:
-            thisNodeLabels.append(f"scope={self.name}")
+            thisNodeShape = "ellipse"
+            headerLabels = (f"scope={self.name}",)
 
         # for each node provide an overall view of
         # - total memory usage accounted for this node (both in bytes and as percentage)
         # - self memory usage (both in bytes and as percentage)
+        totalAlloc = GraphVizUtils.pretty_print_bytes(self.nBytesTotalAllocated)
         if self.nBytesSelfAllocated != self.nBytesTotalAllocated:
-            thisNodeLabels.append(
-                f"total_alloc={GraphVizUtils.pretty_print_bytes(self.nBytesTotalAllocated)} ({self.nTotalWeightPercentage}%)"
-            )
-            thisNodeLabels.append(
-                f"self_alloc={GraphVizUtils.pretty_print_bytes(self.nBytesSelfAllocated)} ({self.nSelfWeightPercentage}%)"
+            selfAlloc = GraphVizUtils.pretty_print_bytes(self.nBytesSelfAllocated)
+            allocLabels = (
+                f"total_alloc={totalAlloc} ({self.nTotalWeightPercentage}%)",
+                f"self_alloc={selfAlloc} ({self.nSelfWeightPercentage}%)",
             )
         else:
             # shorten the label:
-            thisNodeLabels.append(
-                f"total_alloc=self_alloc={GraphVizUtils.pretty_print_bytes(self.nBytesTotalAllocated)} ({self.nTotalWeightPercentage}%)"
+            allocLabels = (
+                f"total_alloc=self_alloc={totalAlloc} ({self.nTotalWeightPercentage}%)",
             )
 
-        thisNodeLabels.append(
-            f"self_freed={GraphVizUtils.pretty_print_bytes(self.nBytesSelfFreed)}"
+        # build all labels in one go; counters of memory operations are shown only if non-zero
+        selfFreed = GraphVizUtils.pretty_print_bytes(self.nBytesSelfFreed)
+        perVisit = GraphVizUtils.pretty_print_bytes(
+            self.get_avg_self_bytes_alloc_per_visit()
         )
-        thisNodeLabels.append(f"visited_times={self.nTimesEnteredAndExited}")
-
-        n = self.get_avg_self_bytes_alloc_per_visit()
-        thisNodeLabels.append(
-            f"self_alloc_per_visit={GraphVizUtils.pretty_print_bytes(n)}"
+        thisNodeLabels = (
+            *headerLabels,
+            *allocLabels,
+            f"self_freed={selfFreed}",
+            f"visited_times={self.nTimesEnteredAndExited}",
+            f"self_alloc_per_visit={perVisit}",
+            *(
+                f"{label}={count}"
+                for label, count in (
+                    ("num_malloc_self", self.nCallsTo_malloc),
+                    ("num_realloc_self", self.nCallsTo_realloc),
+                    ("num_calloc_self", self.nCallsTo_calloc),
+                    ("num_free_self", self.nCallsTo_free),
+                )
+                if count
+            ),
         )
 
-        if self.nCallsTo_malloc:
-            thisNodeLabels.append(f"num_malloc_self={self.nCallsTo_malloc}")
-        if self.nCallsTo_realloc:
-            thisNodeLabels.append(f"num_realloc_self={self.nCallsTo_realloc}")
-        if self.nCallsTo_calloc:
-            thisNodeLabels.append(f"num_calloc_self={self.nCallsTo_calloc}")
-        if self.nCallsTo_free:
-            thisNodeLabels.append(f"num_free_self={self.nCallsTo_free}")
-
         # Calculate the fillcolor in a range from 0-9 based on the "self weight"
         # The idea is to provide an intuitive indication of the self contributions of each malloc scope:
         # The bigger/eye-catching nodes will be those where a lot of byte allocations have been recorded,
         # regardless of what happened inside their children
-        thisNodeFillColor = ""
-        thisNodeFontSize = "14"
-
-        if self.nSelfWeightPercentage < 5:
-            thisNodeFillColor = "1"
-            thisNodeFontSize = "9"
-        elif self.nSelfWeightPercentage < 10:
-            thisNodeFillColor = "2"
-            thisNodeFontSize = "10"
-        elif self.nSelfWeightPercentage < 20:
-            thisNodeFillColor = "3"
-            thisNodeFontSize = "12"
-        elif self.nSelfWeightPercentage < 40:
-            thisNodeFillColor = "4"
-            thisNodeFontSize = "14"
-        elif self.nSelfWeightPercentage < 60:
-            thisNodeFillColor = "5"
-            thisNodeFontSize = "16"
-        elif self.nSelfWeightPercentage < 80:
-            thisNodeFillColor = "6"
-            thisNodeFontSize = "18"
-        else:
-            thisNodeFillColor = "7"
-            thisNodeFontSize = "20"
-
-        # create a name that is unique in the whole graphviz DOT document:
-        thisNodeName = self.get_graphviz_node_name()
-
-        # finally add this node:
-        graph.node(
-            name=thisNodeName,
-            label="\\n".join(thisNodeLabels),
-            shape=thisNodeShape,
-            fillcolor=thisNodeFillColor,
-            fontsize=thisNodeFontSize,
+        idx = bisect.bisect_right(
+            GRAPHVIZ_SELF_WEIGHT_THRESHOLDS, self.nSelfWeightPercentage
         )
+        thisNodeFillColor = GRAPHVIZ_FILL_COLORS[idx]
+        thisNodeFontSize = GRAPHVIZ_FONT_SIZES[idx]
 
-        # write all the connections between this node and its children:
-        for c in self.childrenNodes:
-            edge_label = f"w={self.childrenNodes[c].nTotalWeightPercentage}%"
-            graph.edge(
-                thisNodeName,
-                self.childrenNodes[c].get_graphviz_node_name(),
-                label=edge_label,
-            )
-
-        # now recurse into each children:
-        for c in self.childrenNodes:
-            self.childrenNodes[c].save_as_graphviz_dot(graph)
+        thisNodeLabel = "\\n".join(thisNodeLabels).translate(GRAPHVIZ_QUOTE_ESCAPE)
+        return (
+            f'\t"{thisNodeName}" [label="{thisNodeLabel}" fillcolor={thisNodeFillColor} '
+            f"fontsize={thisNodeFontSize} shape={thisNodeShape}]\n"
+        )
 
     def aggregate_with(self, other: "MallocTagNode"):
-        # reset weights... they will need to be recomputed:
-        self.nTotalWeightPercentage = 0
-        self.nSelfWeightPercentage = 0
-
-        # sum all "summable" properties
-        self.nBytesTotalAllocated += other.nBytesTotalAllocated
-        self.nBytesSelfAllocated += other.nBytesSelfAllocated
-        self.nBytesSelfFreed += other.nBytesSelfFreed
-        self.nTimesEnteredAndExited += other.nTimesEnteredAndExited
-
-        # sum all stats by memory operation:
-        self.nCallsTo_malloc += other.nCallsTo_malloc
-        self.nCallsTo_realloc += other.nCallsTo_realloc
-        self.nCallsTo_calloc += other.nCallsTo_calloc
-        self.nCallsTo_free += other.nCallsTo_free
-
-        # recurse into children:
-        for scopeName in other.childrenNodes.keys():
-
-            # for each scope of the "other" node, check if there is an identical children
-            # also in this node and aggregate them:
-            if scopeName in self.childrenNodes:
-                # same scope is already present... aggregate!
-                self.childrenNodes[scopeName].aggregate_with(
-                    other.childrenNodes[scopeName]
-                )
-            else:
-                # this is a new scope... present only in the 'other' node... add it
-                # as new scope also to this node:
-                self.childrenNodes[scopeName] = other.childrenNodes[scopeName]
+        # the two trees are walked in lockstep using an explicit stack of (this, other) node pairs
+        # instead of Python recursion, to avoid paying one Python frame per node and to avoid
+        # hitting the recursion limit on deep trees
+        aggregated = []
+        stack = [(self, other)]
+        while stack:
+            node, otherNode = stack.pop()
+            aggregated.append(node)
+
+            # reset weights... they will need to be recomputed:
+            node.nTotalWeightPercentage = 0
+            node.nSelfWeightPercentage = 0
+
+            # sum all "summable" properties
+            node.nBytesTotalAllocated += otherNode.nBytesTotalAllocated
+            node.nBytesSelfAllocated += otherNode.nBytesSelfAllocated
+            node.nBytesSelfFreed += otherNode.nBytesSelfFreed
+            node.nTimesEnteredAndExited += otherNode.nTimesEnteredAndExited
+
+            # sum all stats by memory operation:
+            node.nCallsTo_malloc += otherNode.nCallsTo_malloc
+            node.nCallsTo_realloc += otherNode.nCallsTo_realloc
+            node.nCallsTo_calloc += otherNode.nCallsTo_calloc
+            node.nCallsTo_free += otherNode.nCallsTo_free
+
+            # the shape of this subtree is going to change:
+            node.postorderCache = None
+
+            # process children: the children of the 'other' node get moved into this node,
+            # so that no subtree is ever shared between two different trees (shared subtrees
+            # would be counted twice by any later aggregation and would get stale cached stats)
+            otherChildren = otherNode.childrenNodes
+            otherNode.childrenNodes = {}
+            otherNode.postorderCache = None
+            otherNode.update_subtree_stats()
+            for scopeName, otherChild in otherChildren.items():
+
+                # for each scope of the "other" node, check if there is an identical children
+                # also in this node and aggregate them:
+                thisChild = node.childrenNodes.get(scopeName)
+                if thisChild is not None:
+                    # same scope is already present... aggregate!
+                    stack.append((thisChild, otherChild))
+                else:
+                    # this is a new scope... present only in the 'other' node... add it
+                    # as new scope also to this node:
+                    node.childrenNodes[scopeName] = otherChild
+
+        # each node has been aggregated before its children: refresh the subtree stats
+        # in reverse order, so that children stats are up to date before their parent's ones
+        for node in reversed(aggregated):
+            node.update_subtree_stats()
+
+    def update_subtree_stats(self):
+        """
+        Updates the number of nodes and of levels of the subtree rooted in this node,
+        assuming the stats of all children nodes are already up to date.
+        These stats are cached to make get_num_nodes() and get_num_levels() O(1).
+        """
+        nodes = 1  # this current node
+        levels = 0
+        for child in self.childrenNodes.values():
+            nodes += child.nSubtreeNodes
+            if child.nSubtreeLevels > levels:
+                levels = child.nSubtreeLevels
+        self.nSubtreeNodes = nodes
+        self.nSubtreeLevels = levels + 1
 
     def get_num_levels(self):
-        tot = 1
-        if self.childrenNodes:
-            # take the max from children nodes:
-            tot += max(
-                [self.childrenNodes[n].get_num_levels() for n in self.childrenNodes]
-            )
-        return tot
+        return self.nSubtreeLevels
 
     def get_num_nodes(self):
-        tot = 1  # this current node
-        # recurse into children nodes:
-        for t in self.childrenNodes.keys():
-            tot += self.childrenNodes[t].get_num_nodes()
-        return tot
+        return self.nSubtreeNodes
 
     def get_avg_self_bytes_alloc_per_visit(self):
         if self.nTimesEnteredAndExited > 0:
             # it's questionable if we should instead use:
             #                get_net_self_bytes() / m_nTimesEnteredAndExited
-            return int(self.nBytesSelfAllocated / self.nTimesEnteredAndExited)
+            return self.nBytesSelfAllocated // self.nTimesEnteredAndExited
         return 0
     
     def get_net_tracked_bytes(self):
@@ -264,45 +317,87 @@ class MallocTagNode:
             # that apparently we free more memory than what we allocate:
             return 0
 
-    def get_graphviz_node_name(self):
+    def rename(self, name: str):
+        self.name = name
+
         # create a name that is unique in the whole graphviz DOT document:
         # also be aware that colons (:) have a special meaning to graphviz Python library,
         # see https://github.com/xflr6/graphviz/issues/53
         # to avoid troubles we replace colons with underscores in node IDs
         # (but the colons will still appear in the node label)
-        return graphviz.escape(f"{self.ownerTID}_{self.name}").replace(":", "_")
+        # The result is computed only once, since it's needed both when emitting this node
+        # and when emitting the edge coming from its parent.
+        self.graphvizNodeName = graphviz.escape(f"{self.ownerTID}_{name}").replace(
+            ":", "_"
+        )
+
+    def get_graphviz_node_name(self):
+        return self.graphvizNodeName
+
+    def _postorder(self):
+        """
+        Returns the list of all nodes of the subtree rooted in this node, in postorder:
+        each node appears after all its children.
+        An explicit stack is used instead of Python recursion, to avoid paying one
+        Python frame per node and to avoid hitting the recursion limit on deep trees.
+        The result is cached, so that all the tree walks share the same traversal.
+        """
+        if self.postorderCache is not None:
+            return self.postorderCache
+
+        order = []
+        stack = [(self, iter(self.childrenNodes.values()))]
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                # all children of this node have been visited already:
+                stack.pop()
+                order.append(node)
+            else:
+                stack.append((child, iter(child.childrenNodes.values())))
+        self.postorderCache = order
+        return order
 
     def collect_allocated_and_freed_recursively(self):
-        # Postorder traversal of a tree:
-        # First, traverse all children subtrees:
-        alloc_bytes = 0
-        freed_bytes = 0
-        for child in self.childrenNodes:
-            a, f = self.childrenNodes[child].collect_allocated_and_freed_recursively()
-            alloc_bytes += a
-            freed_bytes += f
-
-        # Finally, "visit" this node, updating the bytes count, using all children contributions:
-        self.nBytesTotalAllocated = alloc_bytes + self.nBytesSelfAllocated
-        self.nBytesTotalFreed = freed_bytes + self.nBytesSelfFreed
-
-        # Assume the provided pointers had been initialized to zero at the start of the recursion
+        # Postorder traversal of a tree: each node is "visited" only after all its children
+        # subtrees, so that their total bytes count is already up to date:
+        for node in self._postorder():
+            alloc_bytes = node.nBytesSelfAllocated
+            freed_bytes = node.nBytesSelfFreed
+            children = node.childrenNodes
+            if children:
+                # leaf nodes (typically the majority) skip the creation of the iterator:
+                for child in children.values():
+                    alloc_bytes += child.nBytesTotalAllocated
+                    freed_bytes += child.nBytesTotalFreed
+            node.nBytesTotalAllocated = alloc_bytes
+            node.nBytesTotalFreed = freed_bytes
+
         return self.nBytesTotalAllocated, self.nBytesTotalFreed
 
     def compute_node_weights_recursively(self, allTreesTotalAllocatedBytes):
+        nodes = self._postorder()
         if allTreesTotalAllocatedBytes == 0:
-            self.nTotalWeightPercentage = self.nSelfWeightPercentage = 0
-        else:
-            # Compute weight of this node:
-            self.nTotalWeightPercentage = round(
-                float(100 * self.nBytesTotalAllocated) / allTreesTotalAllocatedBytes, 2
-            )
-            self.nSelfWeightPercentage = round(
-                float(100 * self.nBytesSelfAllocated) / allTreesTotalAllocatedBytes, 2
-            )
-
-        # recurse:
-        for child in self.childrenNodes:
-            self.childrenNodes[child].compute_node_weights_recursively(
-                allTreesTotalAllocatedBytes
-            )
+            for node in nodes:
+                node.nTotalWeightPercentage = node.nSelfWeightPercentage = 0
+            return
+
+        # the weight of each node does not depend on other nodes, so a linear sweep is enough;
+        # the check on the denominator has been done just once, out of the loop.
+        # Moreover many nodes share the same byte counts (e.g. zero, or the self bytes of leaves
+        # which are equal to their total bytes): each distinct weight is computed only once.
+        total = allTreesTotalAllocatedBytes
+        weights = {}
+        for node in nodes:
+            total_bytes = node.nBytesTotalAllocated
+            w = weights.get(total_bytes)
+            if w is None:
+                w = weights[total_bytes] = round(100.0 * total_bytes / total, 2)
+            node.nTotalWeightPercentage = w
+
+            self_bytes = node.nBytesSelfAllocated
+            w = weights.get(self_bytes)
+            if w is None:
+                w = weights[self_bytes] = round(100.0 * self_bytes / total, 2)
+            node.nSelfWeightPercentage = w
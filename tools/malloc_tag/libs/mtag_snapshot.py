@@ -4,12 +4,23 @@
 # Created: Oct 2023
 # License: Apache license
 
+import bz2
+import gzip
+import io
 import json
+import lzma
+import mmap
 import os
 import sys
-import decimal
+import zlib
 import graphviz  # pip3 install graphviz
-from decimal import *
+
+try:
+    import orjson  # optional, much faster JSON (de)serialization: pip3 install orjson
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 
 from malloc_tag.libs.mtag_graphviz_utils import *
 from malloc_tag.libs.mtag_tree import *
@@ -20,19 +31,13 @@ from malloc_tag.libs.mtag_tree import *
 
 TREE_PREFIX = "tree_for_TID"
 
-# =======================================================================================================
-# DecimalEncoder
-# =======================================================================================================
-
-
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        # if passed in object is instance of Decimal ensure accuracy remains of up to 2 digits only
-        if isinstance(obj, Decimal):
-            return round(float(obj), 2)
-        # otherwise use the default behavior:
-        return json.JSONEncoder.default(self, obj)
+# JSON snapshots whose file name ends with one of these extensions are transparently
+# (de)compressed while being loaded/saved:
+COMPRESSED_FILE_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
 
+# size of the buffer used when writing snapshots: JSON snapshots are streamed on disk with
+# many small writes, that are coalesced into few large write() syscalls (or compressor calls)
+JSON_OUTPUT_BUFFER_SIZE = 1 << 20
 
 # =======================================================================================================
 # AggregationRuleDescriptor
@@ -40,6 +45,8 @@ class DecimalEncoder(json.JSONEncoder):
 
 
 class AggregationRuleDescriptor:
+    __slots__ = ("index", "name", "desc")
+
     def __init__(self, index: int, name: str, desc: str):
         self.index = index
         self.name = name
@@ -56,66 +63,232 @@ class MallocTagSnapshot:
     This class represents a JSON snapshot produced by the malloc-tag library for an entire application.
     """
 
+    __slots__ = (
+        "treeRegistry",
+        "pid",
+        "tmStartProfiling",
+        "tmCurrentSnapshot",
+        "nBytesAllocBeforeInit",
+        "nBytesMallocTagSelfUsage",
+        "vmSizeNowBytes",
+        "vmRSSNowBytes",
+        "nTotalNetTrackedBytes",
+        "nTotalAllocBytes",
+        "nTotalFreedBytes",
+    )
+
     def __init__(self):
         self.treeRegistry = {}  # dict indexed by TID
 
-    def __expand(self, snapshot_dict: dict):
-        self.pid = snapshot_dict["PID"]
-        self.tmStartProfiling = snapshot_dict["tmStartProfiling"]
-        self.tmCurrentSnapshot = snapshot_dict["tmCurrentSnapshot"]
-        self.nBytesAllocBeforeInit = snapshot_dict["nBytesAllocBeforeInit"]
-        self.nBytesMallocTagSelfUsage = snapshot_dict["nBytesMallocTagSelfUsage"]
-        self.vmSizeNowBytes = snapshot_dict["vmSizeNowBytes"]
-        self.vmRSSNowBytes = snapshot_dict["vmRSSNowBytes"]
-        self.nTotalNetTrackedBytes = 0 # will be recomputed later
-        self.nTotalAllocBytes = 0 # will be recomputed later
-        self.nTotalFreedBytes = 0 # will be recomputed later
-
-        for thread_tree in snapshot_dict.keys():
-            if thread_tree.startswith("tree_for_"):
+    @staticmethod
+    def __iterate_json_members(text: str):
+        """
+        Incrementally decodes the top-level JSON object contained in the given text,
+        yielding its (key, value) members one at a time.
+        This allows to convert each "tree_for_TID" member into a MallocTree and release its parsed
+        dictionary before the next tree gets decoded: the peak memory usage is then driven by the
+        largest tree rather than by the whole snapshot.
+        """
+        decoder = json.JSONDecoder()
+        skip_whitespace = json.decoder.WHITESPACE.match
+
+        idx = skip_whitespace(text, 0).end()
+        if text[idx : idx + 1] != "{":
+            raise json.decoder.JSONDecodeError("Expecting '{'", text, idx)
+        idx = skip_whitespace(text, idx + 1).end()
+        if text[idx : idx + 1] == "}":
+            return
+
+        while True:
+            if text[idx : idx + 1] != '"':
+                raise json.decoder.JSONDecodeError(
+                    "Expecting property name enclosed in double quotes", text, idx
+                )
+            key, idx = decoder.raw_decode(text, idx)
+            idx = skip_whitespace(text, idx).end()
+            if text[idx : idx + 1] != ":":
+                raise json.decoder.JSONDecodeError("Expecting ':' delimiter", text, idx)
+            idx = skip_whitespace(text, idx + 1).end()
+            value, idx = decoder.raw_decode(text, idx)
+            yield key, value
+            del value
+
+            idx = skip_whitespace(text, idx).end()
+            delimiter = text[idx : idx + 1]
+            idx = skip_whitespace(text, idx + 1).end()
+            if delimiter == "}":
+                break
+            if delimiter != ",":
+                raise json.decoder.JSONDecodeError("Expecting ',' delimiter", text, idx)
+
+        if idx != len(text):
+            raise json.decoder.JSONDecodeError("Extra data", text, idx)
+
+    @staticmethod
+    def __is_compressed(fname: str):
+        return os.path.splitext(fname)[1] in COMPRESSED_FILE_OPENERS
+
+    @staticmethod
+    def __open_snapshot_file(fname: str, mode: str):
+        """
+        Opens the given snapshot file, transparently (de)compressing it if its extension requires so
+        """
+        opener = COMPRESSED_FILE_OPENERS.get(os.path.splitext(fname)[1])
+        if "w" not in mode:
+            return (opener or open)(fname, mode)
+
+        # snapshots are written in binary mode through a large buffer:
+        if opener is None:
+            return open(fname, mode, buffering=JSON_OUTPUT_BUFFER_SIZE)
+        return io.BufferedWriter(
+            opener(fname, mode), buffer_size=JSON_OUTPUT_BUFFER_SIZE
+        )
+
+    @staticmethod
+    def __load_json_with_orjson(json_infile: str):
+        """
+        Decodes the given JSON file with orjson, reading it through a read-only memory map:
+        this avoids copying the whole file into a transient bytes object before parsing it.
+        """
+        if json_infile == "-":
+            # the standard input cannot be memory-mapped either
+            return orjson.loads(sys.stdin.buffer.read())
+        if MallocTagSnapshot.__is_compressed(json_infile):
+            # compressed files cannot be memory-mapped: decompress them in one go
+            with MallocTagSnapshot.__open_snapshot_file(json_infile, "rb") as f:
+                return orjson.loads(f.read())
+
+        with open(json_infile, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # empty files cannot be memory-mapped; let orjson raise the usual decoding error
+                return orjson.loads(b"")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    # the file is parsed front to back: ask the kernel for aggressive read-ahead
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mm) as buf:
+                    return orjson.loads(buf)
+
+    @staticmethod
+    def __pop_json_members(snapshot_dict: dict):
+        """
+        Yields the (key, value) members of an already-decoded JSON snapshot, removing each of them
+        from the dictionary so that the parsed tree gets released as soon as it has been converted.
+        """
+        if not isinstance(snapshot_dict, dict):
+            raise json.decoder.JSONDecodeError("Expecting '{'", "", 0)
+        for key in list(snapshot_dict):
+            yield key, snapshot_dict.pop(key)
+
+    def __expand(self, snapshot_members):
+        """
+        Initialize this object from the (key, value) members of a malloc-tag JSON snapshot
+        """
+        self.nTotalNetTrackedBytes = 0  # will be recomputed later
+        self.nTotalAllocBytes = 0  # will be recomputed later
+        self.nTotalFreedBytes = 0  # will be recomputed later
+
+        snapshot_props = {}
+        trees = []
+        for key, value in snapshot_members:
+            if key.startswith(TREE_PREFIX):
                 t = MallocTree()
-                t.load_json(snapshot_dict[thread_tree])
-                assert t.tid not in self.treeRegistry
-                self.treeRegistry[t.tid] = t
+                t.load_json(value)
+                trees.append((t.tid, t))
+                # release the parsed dictionary before the next member gets decoded:
+                del value
+            else:
+                snapshot_props[key] = value
+
+        # build the registry in one shot, rather than growing it one tree at a time:
+        self.treeRegistry = dict(trees)
+        assert len(self.treeRegistry) == len(trees)  # TIDs must be unique
+
+        self.pid = snapshot_props["PID"]
+        self.tmStartProfiling = snapshot_props["tmStartProfiling"]
+        self.tmCurrentSnapshot = snapshot_props["tmCurrentSnapshot"]
+        self.nBytesAllocBeforeInit = snapshot_props["nBytesAllocBeforeInit"]
+        self.nBytesMallocTagSelfUsage = snapshot_props["nBytesMallocTagSelfUsage"]
+        self.vmSizeNowBytes = snapshot_props["vmSizeNowBytes"]
+        self.vmRSSNowBytes = snapshot_props["vmRSSNowBytes"]
+
+    @staticmethod
+    def abs_path_or_stdin(path: str):
+        """
+        Returns the absolute path of the given snapshot file, or - which load_json() interprets
+        as the standard input. Suitable as argparse type converter.
+        """
+        return path if path == "-" else os.path.abspath(path)
 
     def load_json(self, json_infile: str):
-        # load the JSON
-        wholejson = {}
+        # load the JSON and process it, one tree at a time
         try:
-            f = open(json_infile, "r")
-            text = f.read()
-            f.close()
-            wholejson = json.loads(text)
+            if HAS_ORJSON:
+                # orjson decodes the whole document much faster than the stdlib incremental decoder
+                snapshot_dict = self.__load_json_with_orjson(json_infile)
+                snapshot_members = self.__pop_json_members(snapshot_dict)
+                del snapshot_dict
+            elif json_infile == "-":
+                snapshot_members = self.__iterate_json_members(sys.stdin.read())
+            else:
+                with self.__open_snapshot_file(json_infile, "rt") as f:
+                    text = f.read()
+                snapshot_members = self.__iterate_json_members(text)
+            self.__expand(snapshot_members)
         except json.decoder.JSONDecodeError as err:
             print(f"Invalid input JSON file '{json_infile}': {err}")
             sys.exit(1)
-
-        # process it
-        self.__expand(wholejson)
+        except (OSError, EOFError, lzma.LZMAError, zlib.error) as err:
+            # e.g. a corrupted or truncated compressed file
+            print(f"Failed to read input JSON file '{json_infile}': {err}")
+            sys.exit(1)
 
         # recompute weights and other KPIs
         self.recompute_kpis_across_trees()
 
-    def save_json(self, json_outfile: str):
-        outdict = {
-            "PID": self.pid,
-            "tmStartProfiling": self.tmStartProfiling,
-            "tmCurrentSnapshot": self.tmCurrentSnapshot,
-        }
-        for t in self.treeRegistry.keys():
-            outdict[TREE_PREFIX + str(t)] = self.treeRegistry[t].get_as_dict()
+    @staticmethod
+    def __encode_json_member(key: str, value):
+        """
+        Returns the UTF-8 encoded "key":value pair for a member of the top-level JSON object.
+        The pair is written in compact form (no indentation, no spaces after separators), so that
+        the saved file is the same regardless of orjson being installed or not.
+        """
+        if HAS_ORJSON:
+            # orjson produces directly the UTF-8 encoded document
+            return orjson.dumps(key) + b":" + orjson.dumps(value)
+        encoded_value = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        return (json.dumps(key) + ":" + encoded_value).encode("utf-8")
+
+    def __iterate_snapshot_members(self):
+        """
+        Yields the (key, value) members of the JSON snapshot; the dictionary describing each tree
+        gets built only when that tree is about to be written out.
+        """
+        yield "PID", self.pid
+        yield "tmStartProfiling", self.tmStartProfiling
+        yield "tmCurrentSnapshot", self.tmCurrentSnapshot
+        for t, tree in self.treeRegistry.items():
+            yield TREE_PREFIX + str(t), tree.get_as_dict()
 
         # add last few properties:
-        outdict["nBytesAllocBeforeInit"] = self.nBytesAllocBeforeInit
-        outdict["nBytesMallocTagSelfUsage"] = self.nBytesMallocTagSelfUsage
-        outdict["vmSizeNowBytes"] = self.vmSizeNowBytes
-        outdict["vmRSSNowBytes"] = self.vmRSSNowBytes
-        outdict["nTotalNetTrackedBytes"] = self.nTotalNetTrackedBytes
+        yield "nBytesAllocBeforeInit", self.nBytesAllocBeforeInit
+        yield "nBytesMallocTagSelfUsage", self.nBytesMallocTagSelfUsage
+        yield "vmSizeNowBytes", self.vmSizeNowBytes
+        yield "vmRSSNowBytes", self.vmRSSNowBytes
+        yield "nTotalNetTrackedBytes", self.nTotalNetTrackedBytes
 
-        getcontext().prec = 2
+    def save_json(self, json_outfile: str):
+        # stream the JSON to disk one top-level member at a time: this way only the dictionary
+        # of a single tree is alive at any given time, instead of the dictionary of the whole snapshot
         try:
-            with open(json_outfile, "w", encoding="utf-8") as f:
-                json.dump(outdict, f, ensure_ascii=False, indent=4, cls=DecimalEncoder)
+            with self.__open_snapshot_file(json_outfile, "wb") as f:
+                separator = b"{"
+                for key, value in self.__iterate_snapshot_members():
+                    f.write(separator)
+                    f.write(self.__encode_json_member(key, value))
+                    separator = b",\n"
+                    del value
+                f.write(b"}")
         except Exception as ex:
             print(f"Failed to write the JSON results into {json_outfile}: {ex}")
             return False
@@ -125,68 +298,54 @@ class MallocTagSnapshot:
     def save_graphviz(self, output_fname: str):
         thegraph = graphviz.Digraph(comment="Malloc-tag snapshot")
 
-        labels = []
-        labels.append("Process-wide stats\\n")
-        labels.append(
-            f"allocated_mem_before_malloctag_init={GraphVizUtils.pretty_print_bytes(self.nBytesAllocBeforeInit)}"
-        )
-        labels.append(
-            f"allocated_mem_by_malloctag_itself={GraphVizUtils.pretty_print_bytes(self.nBytesMallocTagSelfUsage)}"
-        )
-        labels.append(
-            f"vm_size_now={GraphVizUtils.pretty_print_bytes(self.vmSizeNowBytes)}"
+        pretty_print_bytes = GraphVizUtils.pretty_print_bytes
+        label = (
+            "Process-wide stats\\n\\n"
+            f"allocated_mem_before_malloctag_init={pretty_print_bytes(self.nBytesAllocBeforeInit)}\\n"
+            f"allocated_mem_by_malloctag_itself={pretty_print_bytes(self.nBytesMallocTagSelfUsage)}\\n"
+            f"vm_size_now={pretty_print_bytes(self.vmSizeNowBytes)}\\n"
+            f"vm_rss_now={pretty_print_bytes(self.vmRSSNowBytes)}\\n"
+            f"tracked_malloc={pretty_print_bytes(self.nTotalAllocBytes)}\\n"
+            f"tracked_free={pretty_print_bytes(self.nTotalFreedBytes)}\\n"
+            f"net_tracked_mem={pretty_print_bytes(self.nTotalNetTrackedBytes)}\\n"
+            f"malloctag_start_ts={self.tmStartProfiling}\\n"
+            f"this_snapshot_ts={self.tmCurrentSnapshot}"
         )
-        labels.append(
-            f"vm_rss_now={GraphVizUtils.pretty_print_bytes(self.vmRSSNowBytes)}"
-        )
-        labels.append(
-            f"tracked_malloc={GraphVizUtils.pretty_print_bytes(self.nTotalAllocBytes)}"
-        )
-        labels.append(
-            f"tracked_free={GraphVizUtils.pretty_print_bytes(self.nTotalFreedBytes)}"
-        )
-        labels.append(
-            f"net_tracked_mem={GraphVizUtils.pretty_print_bytes(self.nTotalNetTrackedBytes)}"
-        )
-        labels.append(f"malloctag_start_ts={self.tmStartProfiling}")
-        labels.append(f"this_snapshot_ts={self.tmCurrentSnapshot}")
 
         # create the main node:
         mainNodeName = f"Process_{self.pid}"
-        thegraph.node(mainNodeName, label="\\n".join(labels))
+        thegraph.node(mainNodeName, label=label)
         # thegraph.attr(colorscheme="reds9", style="filled")
 
-        # used to compute weights later:
-        totalloc, totfreed = self.collect_allocated_and_freed_recursively()
-
-        # now create subgraphs for each and every tree:
-        for t in self.treeRegistry.keys():
-            self.treeRegistry[t].save_as_graphviz_dot(thegraph)
-
-            # compute the weight for the 't'-th tree:
-            treealloc, treefree = self.treeRegistry[
-                t
-            ].collect_allocated_and_freed_recursively()
-            w = 0 if totalloc == 0 else 100 * treealloc / totalloc
-            wstr = f"%.2f%%" % w
-
-            # add edge main node ---> tree
-            thegraph.edge(
-                mainNodeName,
-                self.treeRegistry[t].get_graphviz_root_node_name(),
-                label=wstr,
-            )
+        # used to compute weights later; the totals are kept up to date by recompute_kpis_across_trees():
+        totalloc = self.nTotalAllocBytes
 
         output_fname_root, extension = os.path.splitext(output_fname)
         if extension == ".dot":
-            # NOTE: writing the .source property of the graphviz.Digraph() on disk seems to produce
+            # NOTE: writing the DOT source of the graphviz.Digraph() on disk seems to produce
             # later better results compared to
             #    thegraph.render(outfile=output_fname)
             # because the render() method will put inside the .dot files a lot of width/height/pos attributes
             # that typically break label lines (e.g. "num_malloc_self=0" becomes "num_malloc_", newline and then "self=0")
+            # The DOT source is streamed on disk one tree at a time: the body of the main graph is used
+            # as buffer for the statements of a single tree, instead of accumulating those of all trees
             with open(output_fname, "w") as file:
-                file.write(thegraph.source)
-        elif extension == ".gv":
+                # everything up to the main node, then the closing brace:
+                *head, tail = thegraph
+                file.writelines(head)
+                for tree in self.treeRegistry.values():
+                    thegraph.body.clear()
+                    self.__add_tree_to_graphviz(thegraph, mainNodeName, tree, totalloc)
+                    file.writelines(thegraph.body)
+                file.write(tail)
+            print(f"Saved rendered JSON as Graphviz format into {output_fname}")
+            return True
+
+        # now create subgraphs for each and every tree:
+        for tree in self.treeRegistry.values():
+            self.__add_tree_to_graphviz(thegraph, mainNodeName, tree, totalloc)
+
+        if extension == ".gv":
             thegraph.render(outfile=output_fname)
         elif extension in [".svg", ".svgz", ".png", ".jpeg", ".jpg", ".gif", ".bmp"]:
             thegraph.render(outfile=output_fname)
@@ -206,10 +365,28 @@ class MallocTagSnapshot:
         print(f"Saved rendered JSON as Graphviz format into {output_fname}")
         return True
 
-    def print_stats(self):
-        num_nodes = sum(
-            [self.treeRegistry[t].get_num_nodes() for t in self.treeRegistry]
+    def __add_tree_to_graphviz(
+        self, thegraph, mainNodeName: str, tree: "MallocTree", totalloc: int
+    ):
+        """
+        Adds to the given graph the subgraph of the given tree, linked to the main node
+        """
+        tree.save_as_graphviz_dot(thegraph)
+
+        # compute the weight for the tree:
+        treealloc, treefree = tree.collect_allocated_and_freed_recursively()
+        w = 0 if totalloc == 0 else 100 * treealloc / totalloc
+        wstr = f"%.2f%%" % w
+
+        # add edge main node ---> tree
+        thegraph.edge(
+            mainNodeName,
+            tree.get_graphviz_root_node_name(),
+            label=wstr,
         )
+
+    def print_stats(self):
+        num_nodes = sum(tree.get_num_nodes() for tree in self.treeRegistry.values())
         print(
             f"Loaded a total of {len(self.treeRegistry)} trees containing {num_nodes} nodes."
         )
@@ -217,18 +394,31 @@ class MallocTagSnapshot:
     def aggregate_thread_trees(
         self, tid1: int, tid2: int, rule: "AggregationRuleDescriptor"
     ):
-        # do the aggregation
-        self.treeRegistry[tid1].aggregate_with(self.treeRegistry[tid2], rule)
-        # remove the aggregated tree:
-        del self.treeRegistry[tid2]
-        # update all node weights:
-        self.recompute_kpis_across_trees()
+        """
+        Aggregates the tree 'tid2' into the tree 'tid1'.
+        Node weights and the other snapshot KPIs are NOT updated: when done with all aggregations,
+        the caller must invoke recompute_kpis_across_trees() just once.
+        """
+        self.aggregate_thread_trees_many(tid1, [tid2], rule)
+
+    def aggregate_thread_trees_many(
+        self, tid1: int, otherTids: list, rule: "AggregationRuleDescriptor"
+    ):
+        """
+        Aggregates all the trees 'otherTids' into the tree 'tid1'.
+        'otherTids' can be any iterable: it gets consumed just once.
+        Node weights and the other snapshot KPIs are NOT updated: when done with all aggregations,
+        the caller must invoke recompute_kpis_across_trees() just once.
+        """
+        # remove the trees to aggregate from the registry and do the aggregation:
+        otherTrees = [self.treeRegistry.pop(t) for t in otherTids]
+        self.treeRegistry[tid1].aggregate_with_many(otherTrees, rule)
 
     def collect_allocated_and_freed_recursively(self):
         totalloc = 0
         totfreed = 0
-        for t in self.treeRegistry.keys():
-            a, f = self.treeRegistry[t].collect_allocated_and_freed_recursively()
+        for tree in self.treeRegistry.values():
+            a, f = tree.collect_allocated_and_freed_recursively()
             totalloc += a
             totfreed += f
         return totalloc, totfreed
@@ -237,10 +427,11 @@ class MallocTagSnapshot:
         self.nTotalAllocBytes, self.nTotalFreedBytes = self.collect_allocated_and_freed_recursively()
 
         # in each tree, recompute node weights using the total allocated as denominator:
+        total_alloc = self.nTotalAllocBytes
         total_net_memory = 0
-        for t in self.treeRegistry.keys():
-            self.treeRegistry[t].compute_node_weights_recursively(self.nTotalAllocBytes)
-            total_net_memory += self.treeRegistry[t].get_net_tracked_bytes()
+        for tree in self.treeRegistry.values():
+            tree.compute_node_weights_recursively(total_alloc)
+            total_net_memory += tree.get_net_tracked_bytes()
 
         # recompute the "total net" memory tracked: TOT_ALLOC - TOT_FREED
         self.nTotalNetTrackedBytes = total_net_memory
@@ -7,19 +7,11 @@
 import json
 import os
 import sys
-import decimal
 import graphviz  # pip3 install graphviz
-from decimal import *
 
 from malloc_tag.libs.mtag_graphviz_utils import *
 from malloc_tag.libs.mtag_node import *
 
-# =======================================================================================================
-# GLOBALs
-# =======================================================================================================
-
-SCOPE_PREFIX = "scope_"
-
 # =======================================================================================================
 # MallocTree
 # =======================================================================================================
@@ -30,14 +22,29 @@ class MallocTree:
     This class represents a JSON tree produced by the malloc-tag library for an entire thread.
     """
 
+    # the set of attributes is fixed: no need for a per-instance __dict__
+    __slots__ = (
+        "treeRootNode",
+        "manipulatedByRule",
+        "cachedTotals",
+        "tid",
+        "name",
+        "nPushNodeFailures",
+        "nFreeTrackingFailed",
+        "nMaxTreeNodes",
+        "nVmSizeAtCreation",
+    )
+
     def __init__(self):
         self.treeRootNode = None
         self.manipulatedByRule = None
+        self.cachedTotals = None  # (allocated, freed) bytes, see collect_allocated_and_freed_recursively()
 
     def load_json(self, tree_dict: dict):
         """
         Initialize this object from the given dictionary (obtained from a malloc-tag JSON snapshot)
         """
+        self.cachedTotals = None
         self.tid = tree_dict["TID"]
         self.name = tree_dict["ThreadName"]
         self.nPushNodeFailures = tree_dict["nPushNodeFailures"]
@@ -55,13 +62,13 @@ class MallocTree:
                 f"WARNING: found malloc-tag failures in tracking mem allocations inside the tree {self.name}"
             )
 
-        for k in tree_dict.keys():
+        for k, v in tree_dict.items():
             if k.startswith(SCOPE_PREFIX):
                 # found the root node
                 # print(k)
                 assert self.treeRootNode is None
                 self.treeRootNode = MallocTagNode(owner_tid=self.tid)
-                self.treeRootNode.load_json(tree_dict[k], k[len(SCOPE_PREFIX) :])
+                self.treeRootNode.load_json(v, sys.intern(k[SCOPE_PREFIX_LEN:]))
 
     def get_as_dict(self):
         d = {
@@ -82,25 +89,34 @@ class MallocTree:
     def save_as_graphviz_dot(self, graph):
         # let's use the digraph/subgraph label to convey extra info about this MallocTree:
         nTreeNodesInUse = self.get_num_nodes()
-        labels = []
-        labels.append(f"TID={self.tid}")
-        labels.append(f"nPushNodeFailures={self.nPushNodeFailures}")
-        labels.append(f"nTreeNodesInUse/Max={nTreeNodesInUse}/{self.nMaxTreeNodes}")
+        label = (
+            f"TID={self.tid}\\n"
+            f"nPushNodeFailures={self.nPushNodeFailures}\\n"
+            f"nTreeNodesInUse/Max={nTreeNodesInUse}/{self.nMaxTreeNodes}"
+        )
         if self.manipulatedByRule:
-            labels.append(f"manipulatedByRule={self.manipulatedByRule}")
+            label += f"\\nmanipulatedByRule={self.manipulatedByRule}"
 
         # create one graph for each MallocTree
         tree_graph = graphviz.Digraph(
             name=f"cluster_TID{self.tid}",
             node_attr={"colorscheme": "reds9", "style": "filled"},
         )
-        tree_graph.attr(label="\\n".join(labels), labelloc="b", fontsize="20")
-        self.treeRootNode.save_as_graphviz_dot(tree_graph)
+        tree_graph.attr(label=label, labelloc="b", fontsize="20")
+        self.treeRootNode.save_as_graphviz_dot(tree_graph.body)
 
         # finally add the graph into the "big one" as subgraph
         graph.subgraph(tree_graph)
 
     def aggregate_with(self, other: "MallocTree", rule: "AggregationRuleDescriptor"):
+        self.aggregate_with_many([other], rule)
+
+    def aggregate_with_many(self, others: list, rule: "AggregationRuleDescriptor"):
+        """
+        Aggregates all the given trees into this one.
+        Compared to aggregating them one at a time, the thread names are joined and the root node
+        is renamed just once.
+        """
         # the TID associated with a tree that has been aggregated with another one, makes no sense anymore;
         # on the other hand we still need to assign a number "as unique as possible" because the MallocTagSnapshot
         # class is using the TID as (unique) key for each tree;
@@ -108,21 +124,37 @@ class MallocTree:
         # tree will contain the aggregation result
         self.tid = rule.index
         self.manipulatedByRule = rule.desc
-        self.name += "," + other.name
-        self.nPushNodeFailures += other.nPushNodeFailures
-        self.nFreeTrackingFailed += other.nFreeTrackingFailed
-        self.nMaxTreeNodes = max(self.nMaxTreeNodes, other.nMaxTreeNodes)
-        self.nVmSizeAtCreation = max(self.nVmSizeAtCreation, other.nVmSizeAtCreation)
-        self.treeRootNode.aggregate_with(other.treeRootNode)
-        self.treeRootNode.name = rule.name
+        self.name = ",".join([self.name] + [other.name for other in others])
+        for other in others:
+            self.nPushNodeFailures += other.nPushNodeFailures
+            self.nFreeTrackingFailed += other.nFreeTrackingFailed
+            self.nMaxTreeNodes = max(self.nMaxTreeNodes, other.nMaxTreeNodes)
+            self.nVmSizeAtCreation = max(
+                self.nVmSizeAtCreation, other.nVmSizeAtCreation
+            )
+            self.treeRootNode.aggregate_with(other.treeRootNode)
+        self.cachedTotals = None
+        self.treeRootNode.rename(rule.name)
 
     def collect_allocated_and_freed_recursively(self):
-        return self.treeRootNode.collect_allocated_and_freed_recursively()
+        # the totals of a tree change only when it gets aggregated with another one,
+        # so avoid walking the whole tree again on each call:
+        if self.cachedTotals is None:
+            self.cachedTotals = (
+                self.treeRootNode.collect_allocated_and_freed_recursively()
+            )
+        return self.cachedTotals
     
     def get_net_tracked_bytes(self):
         return self.treeRootNode.get_net_tracked_bytes()
 
     def compute_node_weights_recursively(self, allTreesTotalAllocatedBytes):
+        """
+        Recomputes the weight of all nodes.
+        Node totals are collected first, if not cached already: the weights are then assigned by
+        sweeping the same postorder list of nodes used to collect the totals.
+        """
+        self.collect_allocated_and_freed_recursively()
         self.treeRootNode.compute_node_weights_recursively(allTreesTotalAllocatedBytes)
 
     def get_num_levels(self):
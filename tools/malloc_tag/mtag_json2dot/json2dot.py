@@ -39,6 +39,7 @@ def parse_command_line():
     parser.add_argument(
         "-o",
         "--output",
+        type=os.path.abspath,
         help="The name of the output Graphviz file. The file type is auto-detected from file extension. Supported extensions include: .dot, .svg, .png, .jpeg",
         default=None,
     )
@@ -56,7 +57,8 @@ def parse_command_line():
     parser.add_argument(
         "input",
         nargs="?",
-        help="The JSON file containing the malloc-tag snapshot that must be rendered.",
+        help="The JSON file containing the malloc-tag snapshot that must be rendered. Use - to read it from standard input.",
+        type=MallocTagSnapshot.abs_path_or_stdin,
         default=None,
     )
 
@@ -81,14 +83,6 @@ def parse_command_line():
         parser.print_help()
         sys.exit(os.EX_USAGE)
 
-    if args.input != "-" and not os.path.isabs(args.input):
-        # take absolute path
-        args.input = os.path.join(os.getcwd(), args.input)
-
-    if args.output is not None and not os.path.isabs(args.output):
-        # take absolute path
-        args.output = os.path.join(os.getcwd(), args.output)
-
     return {
         "input_json": args.input,
         "output_file": args.output,
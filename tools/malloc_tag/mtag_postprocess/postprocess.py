@@ -15,9 +15,16 @@ import json
 import os
 import sys
 import re
-import decimal
-import importlib
-from decimal import *
+import functools
+import itertools
+
+try:
+    import orjson  # optional, much faster JSON (de)serialization: pip3 install orjson
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 from malloc_tag.libs.mtag_node import *
 from malloc_tag.libs.mtag_tree import *
 from malloc_tag.libs.mtag_snapshot import *
@@ -27,6 +34,24 @@ from malloc_tag.libs.mtag_snapshot import *
 # =======================================================================================================
 
 THIS_SCRIPT_PYPI_PACKAGE = "malloctag-tools"
+NO_RULES_MESSAGE = "No postprocessing rules specified (see --config). The malloc-tag snapshot will not be manipulated."
+verbose = False
+REGEX_METACHARS = re.compile(r"[.^$*+?{}\[\]\\|()]")
+REGEX_MULTIPLE_WILDCARDS = re.compile(r"\.[*+].*\.[*+]")
+# NOTE: re.Pattern is not available in Python 3.6:
+REGEX_PATTERN_TYPE = type(REGEX_METACHARS)
+REGEX_DEFAULT_FLAGS = re.compile("").flags
+
+
+# =======================================================================================================
+# REGEX HELPERS
+# =======================================================================================================
+
+
+@functools.lru_cache(maxsize=256)
+def compile_regex(pattern: str):
+    # NOTE: several rules may share the same regex: compile each distinct regex just once
+    return re.compile(pattern)
 
 
 # =======================================================================================================
@@ -42,6 +67,7 @@ class PostProcessAggregationRule:
         self.ruleIdx = ruleIdx
         self.matchingRegex = ""
         self.regex = None
+        self.literalPrefix = None
 
     def load(self, cfg_dict):
 
@@ -58,23 +84,42 @@ class PostProcessAggregationRule:
 
         self.matchingRegex = cfg_dict[rulename][pname]
         try:
-            self.regex = re.compile(self.matchingRegex)
-            return True
+            self.regex = compile_regex(self.matchingRegex)
         except:
             print(
                 f"{self.logprefix()} Invalid regex [{self.matchingRegex}]. Aborting."
             )
             return False
 
+        # matches() must call the methods of the compiled pattern, not re.match():
+        assert isinstance(self.regex, REGEX_PATTERN_TYPE)
+        if REGEX_METACHARS.search(self.matchingRegex) is None:
+            # matching this regex is just the same as checking for a literal prefix:
+            self.literalPrefix = self.matchingRegex
+        elif REGEX_MULTIPLE_WILDCARDS.search(self.matchingRegex) is not None:
+            print(
+                f"WARN: {self.logprefix()} The regex [{self.matchingRegex}] contains multiple wildcards: matching long thread names might be slow due to backtracking."
+            )
+        return True
+
     def logprefix(self):
         return f"Rule#{self.ruleIdx}:"
 
-    def apply(self, snapshot: MallocTagSnapshot):
-        matching_tids = [
-            tid
-            for tid in snapshot.treeRegistry
-            if re.match(self.regex, snapshot.treeRegistry[tid].name)
-        ]
+    def matches(self, name: str):
+        """
+        Returns True if the given thread name matches this rule
+        """
+        if self.literalPrefix is not None:
+            return name.startswith(self.literalPrefix)
+        return self.regex.match(name) is not None
+
+    def apply(self, snapshot: MallocTagSnapshot, matching_tids: list):
+        """
+        Applies this rule to the given snapshot.
+        The TIDs of the trees matching this rule are provided by the caller, in the same order
+        they have inside the snapshot.
+        Returns the TID of the tree resulting from the aggregation, or None if nothing was aggregated.
+        """
         if len(matching_tids) == 0:
             print(
                 f"{self.logprefix()} Could not find any tree matching the regex [{self.matchingRegex}]"
@@ -84,16 +129,29 @@ class PostProcessAggregationRule:
                 f"{self.logprefix()} Found only 1 tree matching the regex [{self.matchingRegex}]. Nothing to aggregate."
             )
         else:
-            print(
-                f"{self.logprefix()} Found {len(matching_tids)} trees matching the prefix [{self.matchingRegex}] with TIDs: {matching_tids}"
-            )
+            if verbose:
+                print(
+                    f"{self.logprefix()} Found {len(matching_tids)} trees matching the prefix [{self.matchingRegex}] with TIDs: {matching_tids}"
+                )
+            else:
+                # NOTE: the list of TIDs can be very long: print it only in verbose mode
+                print(
+                    f"{self.logprefix()} Found {len(matching_tids)} trees matching the prefix [{self.matchingRegex}]"
+                )
 
             rule = AggregationRuleDescriptor(self.ruleIdx, self.matchingRegex, f"{self.logprefix()} aggregate threads {self.matchingRegex}")
 
             firstTid = matching_tids[0]
-            for otherTid in matching_tids[1:]:
-                snapshot.aggregate_thread_trees(firstTid, otherTid, rule)
+            snapshot.aggregate_thread_trees_many(firstTid, matching_tids[1:], rule)
+            # update all node weights, just once after all aggregations:
+            snapshot.recompute_kpis_across_trees()
             print(f"{self.logprefix()} Aggregation completed.")
+            return firstTid
+        return None
+
+
+# all supported postprocessing modes, each mapped to the class implementing it:
+RULE_TYPES = {PostProcessAggregationRule.RULE_NAME: PostProcessAggregationRule}
 
 
 # =======================================================================================================
@@ -107,56 +165,113 @@ class PostProcessConfig:
 
     def __init__(self):
         self.rules = []
+        self.combinedRegex = None
 
     def load(self, cfg_json):
-        wholejson = {}
         try:
-            f = open(cfg_json, "r")
-            text = f.read()
-            f.close()
-            wholejson = json.loads(text)
-        except json.decoder.JSONDecodeError as err:
+            with open(cfg_json, "rb") as f:
+                text = f.read()
+        except OSError as err:
+            print(f"Failed to read configuration JSON file '{cfg_json}': {err}")
+            sys.exit(1)
+
+        try:
+            wholejson = orjson.loads(text) if HAS_ORJSON else json.loads(text)
+        except ValueError as err:
+            # JSON decoding errors, including invalid UTF-8 sequences
             print(f"Invalid configuration JSON file '{cfg_json}': {err}")
             sys.exit(1)
+        if not isinstance(wholejson, dict):
+            print(
+                f"Invalid configuration JSON file '{cfg_json}': expected a JSON object"
+            )
+            sys.exit(1)
 
         nrule = 0
-        for rule in wholejson:
+        for rule, ruleBody in wholejson.items():
             if not rule.startswith("rule"):
                 print(
                     f"WARN: In configuration JSON file '{cfg_json}': ignoring key not starting with [rule] prefix: '{rule}'"
                 )
                 continue
-            if len(wholejson[rule]) != 1:
+            try:
+                ((mode, _),) = ruleBody.items()
+            except (AttributeError, ValueError):
                 print(
                     f"In configuration JSON file '{cfg_json}': in rule '{rule}': expected exactly 1 mode"
                 )
                 sys.exit(1)
 
-            mode = next(iter(wholejson[rule]))
-
-            if mode == PostProcessAggregationRule.RULE_NAME:
-                t = PostProcessAggregationRule(nrule)
-                if not t.load(wholejson[rule]):
-                    sys.exit(1)
-                self.rules.append(t)
-                nrule += 1
-            else:
+            ruleType = RULE_TYPES.get(mode)
+            if ruleType is None:
                 print(
                     f"In configuration JSON file '{cfg_json}': in rule '{rule}': found unsupported mode '{mode}'"
                 )
                 sys.exit(1)
+            t = ruleType(nrule)
+            if not t.load(ruleBody):
+                sys.exit(1)
+            self.rules.append(t)
+            nrule += 1
         print(
             f"Loaded {len(self.rules)} postprocessing rules from config file '{cfg_json}'."
         )
+        self.combinedRegex = self.__combine_rule_regexes()
+
+    def __combine_rule_regexes(self):
+        """
+        Returns a single regex that tells, with just 1 match() call, which rules are matching a
+        thread name: the i-th group of the match is not None if the i-th rule regex matches.
+        Each rule regex is wrapped in an optional lookahead, so that all rules get evaluated at
+        the start of the name, just like a match() of each rule regex would do.
+        Returns None if the rule regexes cannot be combined safely.
+        """
+        if len(self.rules) < 2:
+            return None
+        if any(r.regex.groups > 0 for r in self.rules):
+            # groups (and backreferences to them) of the rule regexes would be renumbered
+            return None
+        if any(r.regex.flags != REGEX_DEFAULT_FLAGS for r in self.rules):
+            # global inline flags, e.g. (?i), would apply to all rules of the combined regex
+            # (Python < 3.11 accepts them also in the middle of a regex)
+            return None
+        try:
+            return re.compile(
+                "".join(f"(?:(?=({r.matchingRegex}))|)" for r in self.rules)
+            )
+        except re.error:
+            return None
+
+    def __match_rules(self, name: str):
+        """
+        Returns a tuple telling, for each rule, if it matches the given thread name
+        """
+        if self.combinedRegex is None:
+            return tuple(r.matches(name) for r in self.rules)
+        return tuple(g is not None for g in self.combinedRegex.match(name).groups())
 
     def apply(self, snapshot: MallocTagSnapshot):
         if len(self.rules) == 0:
-            print(
-                f"No postprocessing rules specified (see --config). The malloc-tag snapshot will not be manipulated."
-            )
+            print(NO_RULES_MESSAGE)
             return
-        for r in self.rules:
-            r.apply(snapshot)
+
+        # find out the rules matching each tree with a single pass over the snapshot:
+        match_rules = self.__match_rules
+        treeRegistry = snapshot.treeRegistry
+        rulesMatching = {
+            tid: match_rules(tree.name) for tid, tree in treeRegistry.items()
+        }
+        for i, r in enumerate(self.rules):
+            matching_tids = [tid for tid, m in rulesMatching.items() if m[i]]
+            aggregatedTid = r.apply(snapshot, matching_tids)
+            if aggregatedTid is not None:
+                # the aggregated trees are gone, while the resulting tree got a new name,
+                # which might be matched by the next rules:
+                for tid in itertools.islice(matching_tids, 1, None):
+                    del rulesMatching[tid]
+                rulesMatching[aggregatedTid] = match_rules(
+                    treeRegistry[aggregatedTid].name
+                )
 
 
 # =======================================================================================================
@@ -174,6 +289,7 @@ def parse_command_line():
     parser.add_argument(
         "-o",
         "--output",
+        type=os.path.abspath,
         help="The name of the output JSON file where post-processed results must be stored.",
         default=None,
     )
@@ -197,7 +313,8 @@ def parse_command_line():
     parser.add_argument(
         "input",
         nargs="?",
-        help="The malloc-tag snapshot JSON file to analyze.",
+        help="The malloc-tag snapshot JSON file to analyze. Use - to read it from standard input.",
+        type=MallocTagSnapshot.abs_path_or_stdin,
         default=None,
     )
 
@@ -222,14 +339,6 @@ def parse_command_line():
         parser.print_help()
         sys.exit(os.EX_USAGE)
 
-    if args.input != "-" and not os.path.isabs(args.input):
-        # take absolute path
-        args.input = os.path.join(os.getcwd(), args.input)
-
-    if args.output is not None and not os.path.isabs(args.output):
-        # take absolute path
-        args.output = os.path.join(os.getcwd(), args.output)
-
     return {
         "input_json": args.input,
         "output_file": args.output,
@@ -244,13 +353,15 @@ def postprocess_main():
     t.load_json(config["input_json"])
     t.print_stats()
 
-    # load postprocessing cfg:
-    r = PostProcessConfig()
     if config["postprocess_config_file"]:
+        # load postprocessing cfg:
+        r = PostProcessConfig()
         r.load(config["postprocess_config_file"])
 
-    # apply cfg:
-    r.apply(t)
+        # apply cfg:
+        r.apply(t)
+    else:
+        print(NO_RULES_MESSAGE)
 
     # if requested, save the output:
     if config["output_file"]: